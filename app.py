@@ -1,8 +1,13 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, render_template, request
+from flask_compress import Compress
+import orjson
 
 import tides
 
 app = Flask(__name__)
+# tide json is repetitive and compresses well; tiny responses aren't worth it
+app.config["COMPRESS_MIN_SIZE"] = 512
+Compress(app)
 
 
 @app.route("/")
@@ -34,4 +39,6 @@ def index():
 @app.route("/api/tides")
 def _tides():
     args = dict(request.args)
-    return tides.find_tides(**args)
+    # orjson serializes the dataclasses in the result natively, and much
+    # faster than flask's json provider
+    return Response(orjson.dumps(tides.find_tides(**args)), mimetype="application/json")
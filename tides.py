@@ -1,31 +1,46 @@
-import csv
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from decimal import Decimal
 from enum import auto, StrEnum
+from functools import lru_cache
+import json
+import os
 import os.path
+import pickle
 import re
-from typing import Any, Dict, List
+import shutil
+import tempfile
+import time
+from typing import Any, BinaryIO, Callable, Dict, List, Tuple
+import urllib.error
 import urllib.request
+from zoneinfo import ZoneInfo
 
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-import pytz
+import lxml.html
+from lxml.html import HtmlElement
+import numpy as np
+import pandas as pd
 
 ONE_HOUR = 60 * 60
 DATE_FORMAT = "%Y/%m/%d"
 CACHE_DIR = "cache"
 CURRENT_YEAR = datetime.now().year
+# how long a cached NOAA file is used before checking whether it has changed
+REVALIDATE_AFTER = 24 * ONE_HOUR
+# seconds to wait on NOAA before giving up, so a hung server can't hang requests
+DOWNLOAD_TIMEOUT = 10
+# bump whenever Station changes so that stale pickled stations get reparsed
+STATIONS_PICKLE_VERSION = 3
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Station:
     name: str
     state: str
     nos_id: str
     nws_id: str
-    latitude: Decimal
-    longitude: Decimal
+    latitude: float
+    longitude: float
 
 
 class TideType(StrEnum):
@@ -57,19 +72,22 @@ class HoursFilter(StrEnum):
     ANYTIME = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class Daylight:
     sunrise: int
     sunset: int
 
 
-@dataclass
+@dataclass(slots=True)
 class DaylightInfo:
     daylight: Dict[str, Daylight]
-    tz: Any
+    tz: ZoneInfo
+    # sunrise and sunset timestamps indexed by day of year, for vectorized lookups
+    sunrise: np.ndarray
+    sunset: np.ndarray
 
 
-@dataclass
+@dataclass(slots=True)
 class Tide:
     date: str
     tide_type: TideType
@@ -80,27 +98,161 @@ class Tide:
     daylight: Daylight
 
 
+def localize(dti: pd.DatetimeIndex, tz: ZoneInfo) -> pd.DatetimeIndex:
+    """
+    Localize naive datetimes to tz. Ambiguous times resolve to standard time
+    and nonexistent times shift forward an hour, like pytz's localize() did.
+    """
+    return dti.tz_localize(
+        tz,
+        ambiguous=np.zeros(len(dti), dtype=bool),
+        nonexistent=pd.Timedelta(hours=1),
+    )
+
+
+def to_timestamps(dti: pd.DatetimeIndex) -> np.ndarray:
+    """
+    Convert a DatetimeIndex to an array of integer timestamps (seconds)
+    """
+    return dti.as_unit("s").asi8
+
+
+def atomic_write(path: str, write: Callable[[BinaryIO], Any]):
+    """
+    Calls write with a binary file and moves it into place at path once
+    it's done. The file is uniquely named until then, so concurrent writers
+    don't clobber each other and readers never see a partial file.
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # mkstemp creates files readable only by their owner
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def is_fresh(path: str) -> bool:
+    """
+    Returns whether path exists and was fetched or revalidated recently enough
+    to be used without checking with the server.
+    """
+    if not os.path.exists(path):
+        return False
+    # the metadata file is rewritten on every check, the cached file only
+    # when its contents change. files cached before the metadata existed
+    # fall back to their own mtime.
+    meta_file = f"{path}.meta.json"
+    checked = os.path.getmtime(meta_file if os.path.exists(meta_file) else path)
+    return time.time() - checked < REVALIDATE_AFTER
+
+
 def retrieve_url_and_cache(url: str, path: str):
     """
     if path doesn't exist, fetches the url and writes the response to path.
+    if it exists but isn't fresh, revalidates it with a conditional GET using
+    the ETag and Last-Modified headers saved from the previous response.
     """
-    if not os.path.exists(path):
-        with urllib.request.urlopen(url) as f:
-            with open(path, "w") as output:
-                contents = f.read().decode("utf-8")
-                output.write(contents)
+    if is_fresh(path):
+        return
+
+    meta_file = f"{path}.meta.json"
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_file):
+        try:
+            with open(meta_file, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            # unreadable metadata, fall back to an unconditional GET
+            pass
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT
+        ) as f:
+            atomic_write(
+                path, lambda output: shutil.copyfileobj(f, output, length=64 * 1024)
+            )
+            meta = {
+                "etag": f.headers.get("ETag"),
+                "last_modified": f.headers.get("Last-Modified"),
+            }
+    except urllib.error.HTTPError as e:
+        # 304 Not Modified means the cached file is still current. for any
+        # other status, keep serving the stale file like for errors below
+        if e.code != 304 and not os.path.exists(path):
+            raise
+    except OSError:
+        # keep serving a stale file rather than failing when NOAA is
+        # unreachable or times out
+        if not os.path.exists(path):
+            raise
+
+    # rewriting the metadata marks the file as checked, including after a
+    # failed revalidation so the next attempt waits for REVALIDATE_AFTER
+    atomic_write(meta_file, lambda output: output.write(json.dumps(meta).encode()))
+
+
+def retrieve_urls_and_cache(sources: List[Tuple[str, str]]):
+    """
+    Fetches the (url, path) sources that aren't fresh, concurrently.
+    """
+    stale = [(url, path) for url, path in sources if not is_fresh(path)]
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            # consume the results so that any errors are raised here
+            list(executor.map(lambda source: retrieve_url_and_cache(*source), stale))
 
 
-def get_tides(station: Station, year: int) -> List[List[str]]:
+def tides_source(station: Station, year: int) -> Tuple[str, str]:
     """
-    Fetches tide data from NOAA for a given year
+    Returns the NOAA url and cache path for a station's tide data
     """
     # stnid is the monitoring station id (9447130 = Seattle)
     url = f"https://tidesandcurrents.noaa.gov/cgi-bin/predictiondownload.cgi?&stnid={station.nos_id}&threshold=&thresholdDirection=greaterThan&bdate={year}&timezone=LST/LDT&datum=MLLW&clock=24hour&type=txt&annual=true"
 
-    cached_file = f"{CACHE_DIR}/{year}_{station.nos_id}_tides.txt"
+    return url, f"{CACHE_DIR}/{year}_{station.nos_id}_tides.txt"
+
+
+def daylight_source(station: Station, year: int) -> Tuple[str, str]:
+    """
+    Returns the NOAA url and cache path for a station's daylight information
+    """
+    url = f"https://gml.noaa.gov/grad/solcalc/table.php?lat={station.latitude}&lon={station.longitude}&year={year}"
+
+    def format(lat_or_lng):
+        return str(lat_or_lng).replace(".", "_").replace("-", "neg")
+
+    lat_lng = f"{format(station.latitude)}_{format(station.longitude)}"
+
+    return url, f"{CACHE_DIR}/{year}_{lat_lng}_daylight.html"
+
+
+def get_tides(station: Station, year: int) -> pd.DataFrame:
+    """
+    Fetches tide data from NOAA for a given year
+    """
+    url, cached_file = tides_source(station, year)
     retrieve_url_and_cache(url, cached_file)
 
+    return read_tides(cached_file, os.path.getmtime(cached_file))
+
+
+@lru_cache(maxsize=64)
+def read_tides(cached_file: str, mtime: float) -> pd.DataFrame:
+    """
+    Parses a cached tide data file. mtime is only used as part of the cache
+    key, so that the file is parsed again when it's updated.
+    """
     with open(cached_file, "r") as f:
         # skip first section including blank line that follows it
         while len(f.readline().strip()) > 0:
@@ -109,72 +261,90 @@ def get_tides(station: Station, year: int) -> List[List[str]]:
         # skip header
         f.readline()
 
-        # can't use a DictReader, delimiters in the header row are messed up
-        reader = csv.reader(f, delimiter="\t")
-
-        return [row for row in reader]
+        # can't use the header row, delimiters in it are messed up
+        return pd.read_csv(
+            f,
+            sep="\t",
+            header=None,
+            names=["date", "dow", "time", "pred", "_a", "_b", "_c", "_d", "hl"],
+            dtype={"pred": "float64", "hl": "category"},
+        )
 
 
-def parse_table(table: Tag, year: int, tz):
+def parse_table(table: HtmlElement, year: int, tz: ZoneInfo) -> Dict[str, int]:
     """
     Parse HTML table containing sunrise or sunset times
 
     Parameters:
-    table (Tag): BeautifulSoup tag for HTML table
+    table (HtmlElement): lxml element for HTML table
     year (int): the data's year
+
+    Returns a dict of date strings to timestamps
     """
-    times = {}
-    day_of_month = None
-    for row in table.find_all("tr"):
-        for idx, cell in enumerate(row.find_all("td")):
-            text = (cell.string or "").strip()
+    dates = []
+    times = []
+    for row in table.iter("tr"):
+        cells = [(cell.text or "").strip() for cell in row.iterchildren("td")]
+        if not cells or not cells[0]:
+            continue
+        day_of_month = int(cells[0])
+        for month, text in enumerate(cells[1:], start=1):
+            # months without this day have empty cells
             if text:
-                if idx == 0:
-                    day_of_month = int(text)
-                else:
-                    hour, minute = text.split(":")
-                    dt_obj = tz.localize(
-                        datetime(year, idx, day_of_month, int(hour), int(minute))
-                    )
-                    times[dt_obj.strftime(DATE_FORMAT)] = dt_obj
-    return times
+                # same format as the dates in the tides file
+                dates.append(f"{year}/{month:02d}/{day_of_month:02d}")
+                times.append(text)
+
+    dti = localize(
+        pd.to_datetime(
+            [f"{date} {time}" for date, time in zip(dates, times)],
+            format=f"{DATE_FORMAT} %H:%M",
+        ),
+        tz,
+    )
+    return dict(zip(dates, to_timestamps(dti).tolist()))
 
 
 def get_daylight(station: Station, year: int) -> DaylightInfo:
     """
     Fetches daylight information from NOAA
     """
-    url = f"https://gml.noaa.gov/grad/solcalc/table.php?lat={station.latitude}&lon={station.longitude}&year={year}"
-
-    def format(lat_or_lng):
-        return str(lat_or_lng).replace(".", "_").replace("-", "neg")
+    url, cached_file = daylight_source(station, year)
+    retrieve_url_and_cache(url, cached_file)
 
-    lat_lng = f"{format(station.latitude)}_{format(station.longitude)}"
+    return read_daylight(cached_file, year, os.path.getmtime(cached_file))
 
-    cached_file = f"{CACHE_DIR}/{year}_{lat_lng}_daylight.html"
-    retrieve_url_and_cache(url, cached_file)
 
+@lru_cache(maxsize=64)
+def read_daylight(cached_file: str, year: int, mtime: float) -> DaylightInfo:
+    """
+    Parses a cached daylight information file. mtime is only used as part of
+    the cache key, so that the file is parsed again when it's updated.
+    """
     times = {}
 
-    with open(cached_file, "r") as f:
-        soup = BeautifulSoup(f.read(), features="html.parser")
+    # bytes, so that lxml honors the page's declared charset
+    with open(cached_file, "rb") as f:
+        html = lxml.html.fromstring(f.read())
 
-        tz_element = soup.find_all(
-            lambda tag: "Time Zone Offset" in (tag.string or "")
-        )[0]
-        tz_str = re.findall(r"Time Zone Offset: ([\w/]+)", tz_element.string)[0]
-        tz = pytz.timezone(tz_str)
+        tz_text = html.xpath("//text()[contains(., 'Time Zone Offset')]")[0]
+        tz_str = re.findall(r"Time Zone Offset: ([\w/]+)", tz_text)[0]
+        tz = ZoneInfo(tz_str)
 
-        tables = soup.find_all("table")
+        tables = html.xpath("//table")
         sunrise = parse_table(tables[0], year, tz)
         sunset = parse_table(tables[1], year, tz)
 
         for date in sunrise.keys():
-            times[date] = Daylight(
-                int(sunrise[date].timestamp()), int(sunset[date].timestamp())
-            )
+            times[date] = Daylight(sunrise[date], sunset[date])
 
-    return DaylightInfo(times, tz)
+    day_of_year = pd.to_datetime(list(times.keys()), format=DATE_FORMAT).dayofyear
+    sunrise_by_day = np.zeros(367, dtype=np.int64)
+    sunrise_by_day[day_of_year] = [daylight.sunrise for daylight in times.values()]
+    sunset_by_day = np.zeros(367, dtype=np.int64)
+    sunset_by_day[day_of_year] = [daylight.sunset for daylight in times.values()]
+
+    return DaylightInfo(times, tz, sunrise_by_day, sunset_by_day)
 
 
 def get_stations() -> List[Station]:
@@ -183,17 +353,41 @@ def get_stations() -> List[Station]:
     cached_file = f"{CACHE_DIR}/stations.html"
     retrieve_url_and_cache(url, cached_file)
 
+    return read_stations(cached_file, os.path.getmtime(cached_file))
+
+
+@lru_cache(maxsize=1)
+def read_stations(cached_file: str, mtime: float) -> List[Station]:
+    """
+    Parses the cached stations file. mtime is only used as part of the cache
+    key, so that the file is parsed again when it's updated.
+    """
+    # parsed stations are pickled alongside the html so that it only
+    # needs to be parsed again when it changes
+    pickled_file = f"{CACHE_DIR}/stations.pkl"
+    if (
+        os.path.exists(pickled_file)
+        and os.path.getmtime(pickled_file) >= os.path.getmtime(cached_file)
+    ):
+        try:
+            with open(pickled_file, "rb") as f:
+                version, stations = pickle.load(f)
+            if version == STATIONS_PICKLE_VERSION:
+                return stations
+        except Exception:
+            # unreadable or stale pickle, fall back to parsing the html
+            pass
+
     stations = []
 
-    with open(cached_file, "r") as f:
-        soup = BeautifulSoup(f.read(), features="html.parser")
-        tables = soup.css.select("#NWSTable")
-        rows = tables[0].find_all("tr")
-        for row in rows:
-            cols = row.find_all("td")
+    with open(cached_file, "rb") as f:
+        html = lxml.html.fromstring(f.read())
+        table = html.get_element_by_id("NWSTable")
+        for row in table.xpath(".//tr"):
+            cols = row.xpath("./td")
             if len(cols) == 6:
                 nos_id, nws_id, latitude, longitude, state, station_name = [
-                    e.string.strip() for e in row.find_all("td")
+                    e.text_content().strip() for e in cols
                 ]
                 stations.append(
                     Station(
@@ -201,13 +395,17 @@ def get_stations() -> List[Station]:
                         state=state,
                         nos_id=nos_id,
                         nws_id=nws_id,
-                        latitude=Decimal(latitude),
-                        longitude=Decimal(longitude),
+                        latitude=float(latitude),
+                        longitude=float(longitude),
                     )
                 )
 
     stations = sorted(stations, key=lambda station: f"{station.state}, {station.name}")
 
+    atomic_write(
+        pickled_file, lambda f: pickle.dump((STATIONS_PICKLE_VERSION, stations), f)
+    )
+
     return stations
 
 
@@ -239,84 +437,88 @@ def find_tides(
     if isinstance(hours_filter, str):
         hours_filter = HoursFilter(hours_filter)
 
-    def filter_tide_type(value):
-        return tide_type == value
-
-    def filter_day(date: datetime):
-        match (day_filter):
-            case DayFilter.ANY:
-                return True
-            case DayFilter.WEEKDAY:
-                return date.weekday() <= 4
-            case DayFilter.WEEKEND:
-                return date.weekday() >= 5
-
-    def filter_hours(date: datetime, daylight_obj: Daylight):
-        date_ts = date.timestamp()
-        match (hours_filter):
-            case HoursFilter.DAY:
-                return (
-                    date_ts >= daylight_obj.sunrise and date_ts <= daylight_obj.sunset
-                )
-            case HoursFilter.DAY_1:
-                return date_ts >= (daylight_obj.sunrise - ONE_HOUR) and date_ts <= (
-                    daylight_obj.sunset + ONE_HOUR
-                )
-            case HoursFilter.NIGHT:
-                return date_ts < daylight_obj.sunrise or date_ts > daylight_obj.sunset
-            case HoursFilter.ANYTIME:
-                return True
-
     if isinstance(year, str):
         year = int(year)
 
+    # on a cold cache, download both files at once rather than one after the other
+    retrieve_urls_and_cache(
+        [tides_source(station, year), daylight_source(station, year)]
+    )
+
     daylight_info = get_daylight(station, year)
     tz = daylight_info.tz
 
-    all_tides = []
-
-    for row in get_tides(station, year):
-        (date, dow, time, pred_, _, _, _, _, hl) = row
-        pred = float(pred_)
-        year, month, day_of_month = [int(part) for part in date.split("/")]
-        hour, minute = [int(part) for part in time.split(":")]
-
-        # sanity check parsing
-        assert hl in ["H", "L"]
-
-        dt_obj = tz.localize(datetime(year, month, day_of_month, hour, minute))
-        daylight_obj = daylight_info.daylight[date]
-
-        all_tides.append(
-            Tide(
-                dt_obj.strftime(DATE_FORMAT),
-                TideType(hl),
-                dt_obj,
-                int(dt_obj.timestamp()),
-                pred,
-                daylight_obj,
+    df = get_tides(station, year)
+    hls = df["hl"].to_numpy()
+    preds = df["pred"].to_numpy()
+
+    # sanity check parsing. hl is categorical, so checking its categories
+    # covers every row without a per-row membership test
+    assert set(df["hl"].cat.categories) <= {"H", "L"} and not df["hl"].hasnans
+
+    # the tide type and prediction checks only need the raw columns, so apply
+    # them first and only parse the datetimes of the rows that pass.
+    # tide_type values start with the same letter as the file's H/L column
+    tide_char = tide_type.value[0].upper()
+    candidates = df[(hls == tide_char) & (preds < prediction_limit)]
+    dates = candidates["date"].to_numpy()
+    candidate_preds = candidates["pred"].to_numpy()
+
+    dti = localize(
+        pd.DatetimeIndex(
+            pd.to_datetime(
+                candidates["date"] + " " + candidates["time"],
+                format=f"{DATE_FORMAT} %H:%M",
             )
-        )
+        ),
+        tz,
+    )
+    ts = to_timestamps(dti)
+    mask = np.ones(len(candidates), dtype=bool)
+
+    # each filter is resolved once and only computes the columns it needs
+    match (day_filter):
+        case DayFilter.WEEKDAY:
+            mask &= dti.weekday.values <= 4
+        case DayFilter.WEEKEND:
+            mask &= dti.weekday.values >= 5
+
+    if hours_filter != HoursFilter.ANYTIME:
+        day_of_year = dti.dayofyear.values
+        sunrise = daylight_info.sunrise[day_of_year]
+        sunset = daylight_info.sunset[day_of_year]
 
+        match (hours_filter):
+            case HoursFilter.DAY:
+                mask &= (ts >= sunrise) & (ts <= sunset)
+            case HoursFilter.DAY_1:
+                mask &= (ts >= sunrise - ONE_HOUR) & (ts <= sunset + ONE_HOUR)
+            case HoursFilter.NIGHT:
+                mask &= (ts < sunrise) | (ts > sunset)
+
+    # pull the matching rows out of each column in one call, as python
+    # objects, rather than indexing and converting each row
+    indices = np.nonzero(mask)[0]
     tides = [
-        tide
-        for tide in all_tides
-        if (
-            filter_tide_type(tide.tide_type)
-            and (tide.prediction < prediction_limit)
-            and filter_day(tide.tide_dt)
-            and filter_hours(tide.tide_dt, tide.daylight)
+        Tide(
+            date, tide_type, tide_dt, tide_ts, prediction, daylight_info.daylight[date]
+        )
+        for date, tide_dt, tide_ts, prediction in zip(
+            dates[indices].tolist(),
+            dti[indices].to_pydatetime(),
+            ts[indices].tolist(),
+            candidate_preds[indices].tolist(),
         )
     ]
 
-    highs = [tide.prediction for tide in all_tides if tide.tide_type == TideType.HIGH]
-    high_avg = round(sum(highs) / len(highs), 2)
-    high_min = round(min(highs), 2)
-    high_max = round(max(highs), 2)
-    lows = [tide.prediction for tide in all_tides if tide.tide_type == TideType.LOW]
-    low_avg = round(sum(lows) / len(lows), 2)
-    low_min = round(min(lows), 2)
-    low_max = round(max(lows), 2)
+    highs = preds[hls == "H"]
+    high_avg = round(float(highs.mean()), 2)
+    high_min = round(float(highs.min()), 2)
+    high_max = round(float(highs.max()), 2)
+    lows = preds[hls == "L"]
+    low_avg = round(float(lows.mean()), 2)
+    low_min = round(float(lows.min()), 2)
+    low_max = round(float(lows.max()), 2)
 
     return {
         "station": station,
@@ -327,7 +529,7 @@ def find_tides(
         "low_avg": low_avg,
         "low_min": low_min,
         "low_max": low_max,
-        "tz": tz.zone,
+        "tz": tz.key,
     }
 
 